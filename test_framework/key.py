@@ -9,17 +9,40 @@ anything but tests."""
 import random
 import hashlib
 
+def _tagged_hash_midstate(tag):
+    """Return a SHA256 state with SHA256(tag) || SHA256(tag) already absorbed."""
+    tag_hash = hashlib.sha256(tag.encode('utf-8')).digest()
+    return hashlib.sha256(tag_hash + tag_hash)
+
+# Precomputed midstates for the BIP340 and BIP341 tags. Other tags are hashed
+# from scratch on every call.
+_TAG_MIDSTATES = {tag: _tagged_hash_midstate(tag) for tag in (
+    "BIP0340/challenge", "BIP0340/aux", "BIP0340/nonce",
+    "TapLeaf", "TapBranch", "TapTweak", "TapSighash",
+)}
+
 def TaggedHash(tag, data):
-    ss = hashlib.sha256(tag.encode('utf-8')).digest()
-    ss += ss
-    ss += data
-    return hashlib.sha256(ss).digest()
+    midstate = _TAG_MIDSTATES.get(tag)
+    if midstate is None:
+        midstate = _tagged_hash_midstate(tag)
+    h = midstate.copy()
+    h.update(data)
+    return h.digest()
 
 def modinv(a, n):
     """Compute the modular inverse of a modulo n
 
+    Python 3.8+ computes modular inverses natively with pow(a, -1, n), which
+    is considerably faster than the pure Python loop below. pow raises
+    ValueError both when a has no inverse and on older Python versions, in
+    which case we fall back to the extended Euclidean algorithm.
+
     See https://en.wikipedia.org/wiki/Extended_Euclidean_algorithm#Modular_integers.
     """
+    try:
+        return pow(a, -1, n)
+    except ValueError:
+        pass
     t1, t2 = 0, 1
     r1, r2 = n, a
     while r2 != 0:
@@ -99,6 +122,32 @@ class EllipticCurve:
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def affine_batch(self, ps):
+        """Convert a list of Jacobian point tuples to affine form, using a single modular inverse.
+
+        Points at infinity are converted to None. See
+        https://en.wikipedia.org/wiki/Modular_multiplicative_inverse#Multiple_inverses"""
+        # prefix[i] is the product of all non-zero z coordinates up to and including ps[i]
+        prefix = []
+        acc = 1
+        for (_, _, z1) in ps:
+            if z1 != 0:
+                acc = (acc * z1) % self.p
+            prefix.append(acc)
+        inv = modinv(acc, self.p)
+        ret = [None] * len(ps)
+        for i in range(len(ps) - 1, -1, -1):
+            x1, y1, z1 = ps[i]
+            if z1 == 0:
+                continue
+            # inv is the inverse of prefix[i], so this is the inverse of z1
+            inv_z = (inv * prefix[i - 1]) % self.p if i > 0 else inv
+            inv = (inv * z1) % self.p
+            inv_2 = (inv_z**2) % self.p
+            inv_3 = (inv_2 * inv_z) % self.p
+            ret[i] = ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
+        return ret
+
     def has_even_y(self, p1):
         """Whether the point p1 has an even Y coordinate when expressed in affine coordinates."""
         return not (p1[2] == 0 or self.affine(p1)[1] & 1)
@@ -219,6 +268,13 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def sum_points(self, ps):
+        """Add a list of Jacobian tuples, without intermediate affine conversions."""
+        r = (0, 1, 0)
+        for p1 in ps:
+            r = self.add(r, p1)
+        return r
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
@@ -232,18 +288,106 @@ class EllipticCurve:
                     r = self.add(r, p)
         return r
 
+    def odd_multiples(self, p1, w):
+        """Compute the affine table [p1, 3*p1, 5*p1, ..., (2^(w-1)-1)*p1] for a Jacobian tuple p1.
+
+        The table can be passed to mul_with_tables() as a window of width w."""
+        p1 = self.affine(p1)
+        p1_2 = self.affine(self.double(p1))
+        table = [p1]
+        for _ in range((1 << (w - 2)) - 1):
+            table.append(self.add_mixed(table[-1], p1_2))
+        return self.affine_batch(table)
+
+    def fixed_base_table(self, p1, w):
+        """Precompute the affine multiples j*2^(w*i)*p1 of a Jacobian tuple p1, for all 256-bit scalars split in w-bit digits.
+
+        The table can be passed to mul_fixed_base(). Row i contains the multiples for j = 1 .. 2^w-1."""
+        table = []
+        base = self.affine(p1)
+        for _ in range((256 + w - 1) // w):
+            row = [base]
+            for _ in range((1 << w) - 2):
+                row.append(self.add_mixed(row[-1], base))
+            row = self.affine_batch(row)
+            table.append(row)
+            base = self.affine(self.add_mixed(row[-1], base))
+        return table
+
+    def mul_fixed_base(self, table, n):
+        """Compute a point multiplication of a fixed point using its fixed_base_table()
+
+        Every w-bit digit of n selects one precomputed multiple, so no doublings are needed."""
+        w = len(table[0]).bit_length()
+        mask = (1 << w) - 1
+        r = (0, 1, 0)
+        for row in table:
+            d = n & mask
+            if d:
+                r = self.add_mixed(r, row[d - 1])
+            n >>= w
+        assert n == 0
+        return r
+
+    def mul_with_tables(self, ps):
+        """Compute a (multi) point multiplication using precomputed odd multiples
+
+        ps is a list of (table, scalar) pairs, where each table is the output
+        of odd_multiples(). The scalars are recoded in width-w NAF, so only one
+        mixed addition is needed every w+1 bits on average.
+
+        See https://en.wikipedia.org/wiki/Elliptic_curve_point_multiplication#w-ary_non-adjacent_form_(wNAF)_method"""
+        nafs = []
+        for (table, n) in ps:
+            w = len(table).bit_length() + 1
+            digits = []
+            while n:
+                d = 0
+                if n & 1:
+                    d = n & ((1 << w) - 1)
+                    if d >= 1 << (w - 1):
+                        d -= 1 << w
+                    n -= d
+                digits.append(d)
+                n >>= 1
+            nafs.append((table, digits))
+        r = (0, 1, 0)
+        for i in range(max((len(digits) for _, digits in nafs), default=0) - 1, -1, -1):
+            r = self.double(r)
+            for (table, digits) in nafs:
+                if i < len(digits) and digits[i]:
+                    d = digits[i]
+                    if d > 0:
+                        r = self.add_mixed(r, table[d >> 1])
+                    else:
+                        r = self.add_mixed(r, self.negate(table[-d >> 1]))
+        return r
+
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
 SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
+# Multiples of the generator for SECP256K1.mul_fixed_base(), built on first use
+_SECP256K1_G_TABLE = None
+
+def generator_mul(n):
+    """Compute n*G as a Jacobian tuple, using a precomputed table of multiples of the generator."""
+    global _SECP256K1_G_TABLE
+    if _SECP256K1_G_TABLE is None:
+        _SECP256K1_G_TABLE = SECP256K1.fixed_base_table(SECP256K1_G, 4)
+    return SECP256K1.mul_fixed_base(_SECP256K1_G_TABLE, n)
+
 class ECPubKey():
     """A secp256k1 public key"""
 
     def __init__(self):
         """Construct an uninitialized public key"""
         self.valid = False
+        # Affine form of the Jacobian tuple self._affine_p, see get_affine()
+        self._affine_p = None
+        self._affine = None
 
     def __repr__(self):
         return self.get_bytes().hex()
@@ -265,8 +409,10 @@ class ECPubKey():
                 self.compressed = False
         elif (len(data) == 33 and (data[0] == 0x02 or data[0] == 0x03)):
             x = int.from_bytes(data[1:33], 'big')
-            if SECP256K1.is_x_coord(x):
-                p = SECP256K1.lift_x(x)
+            # lift_x fails if x is not a valid X coordinate, so there's no
+            # need to compute its Legendre symbol separately
+            p = SECP256K1.lift_x(x)
+            if p is not None:
                 # if the oddness of the y co-ord isn't correct, find the other
                 # valid y
                 if (p[1] & 1) != (data[0] & 1):
@@ -278,8 +424,10 @@ class ECPubKey():
                 self.valid = False
         elif (len(data) == 32):
             x = int.from_bytes(data[0:32], 'big')
-            if SECP256K1.is_x_coord(x):
-                p = SECP256K1.lift_x(x)
+            # lift_x fails if x is not a valid X coordinate, so there's no
+            # need to compute its Legendre symbol separately
+            p = SECP256K1.lift_x(x)
+            if p is not None:
                 # if the oddness of the y co-ord isn't correct, find the other
                 # valid y
                 if p[1]%2 != 0:
@@ -301,15 +449,25 @@ class ECPubKey():
     def is_valid(self):
         return self.valid
 
+    def get_affine(self):
+        """Return the affine form of this point, or None if at infinity.
+
+        The conversion needs a modular inverse, so the result is cached until
+        self.p is reassigned."""
+        if self._affine_p is not self.p:
+            self._affine = SECP256K1.affine(self.p)
+            self._affine_p = self.p
+        return self._affine
+
     def get_y(self):
-        return SECP256K1.affine(self.p)[1]
+        return self.get_affine()[1]
 
     def get_x(self):
-        return SECP256K1.affine(self.p)[0]
+        return self.get_affine()[0]
 
     def get_bytes(self, bip340=True):
         assert(self.valid)
-        p = SECP256K1.affine(self.p)
+        p = self.get_affine()
         if p is None:
             return None
         if bip340:
@@ -449,7 +607,7 @@ class ECPubKey():
         t = int_or_bytes(tweak)
         if t >= SECP256K1_ORDER:
             return None
-        tweaked = SECP256K1.affine(SECP256K1.mul([(self.p, 1), (SECP256K1_G, t)]))
+        tweaked = SECP256K1.affine(SECP256K1.add(self.p, generator_mul(t)))
         if tweaked is None:
             return None
         ret = ECPubKey()
@@ -589,7 +747,7 @@ class ECKey():
         """Compute an ECPubKey object for this secret key."""
         assert(self.valid)
         ret = ECPubKey()
-        p = SECP256K1.mul([(SECP256K1_G, self.secret)])
+        p = generator_mul(self.secret)
         ret.p = p
         ret.valid = True
         ret.compressed = self.compressed
@@ -604,7 +762,7 @@ class ECKey():
         z = int.from_bytes(msg, 'big')
         # Note: no RFC6979, but a simple random nonce (some tests rely on distinct transactions for the same operation)
         k = random.randrange(1, SECP256K1_ORDER)
-        R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, k)]))
+        R = SECP256K1.affine(generator_mul(k))
         r = R[0] % SECP256K1_ORDER
         s = (modinv(k, SECP256K1_ORDER) * (z + self.secret * r)) % SECP256K1_ORDER
         if low_s and s > SECP256K1_ORDER_HALF:
@@ -628,7 +786,7 @@ class ECKey():
         t = (self.secret ^ int.from_bytes(TaggedHash("BIP0340/aux", aux), 'big')).to_bytes(32, 'big')
         kp = int.from_bytes(TaggedHash("BIP0340/nonce", t + self.get_pubkey().get_bytes() + msg), 'big') % SECP256K1_ORDER
         assert kp != 0
-        R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, kp)]))
+        R = SECP256K1.affine(generator_mul(kp))
         k = kp if SECP256K1.has_even_y(R) else SECP256K1_ORDER - kp
         e = int.from_bytes(TaggedHash("BIP0340/challenge", R[0].to_bytes(32, 'big') + self.get_pubkey().get_bytes() + msg), 'big') % SECP256K1_ORDER
         return R[0].to_bytes(32, 'big') + ((k + e * self.secret) % SECP256K1_ORDER).to_bytes(32, 'big')
@@ -674,7 +832,7 @@ def generate_schnorr_nonce():
     This implementation ensures the y-coordinate of the nonce point is even."""
     kp = random.randrange(1, SECP256K1_ORDER)
     assert kp != 0
-    R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, kp)]))
+    R = SECP256K1.affine(generator_mul(kp))
     k = kp if R[1] % 2 == 0 else SECP256K1_ORDER - kp
     k_key = ECKey()
     k_key.set(k.to_bytes(32, 'big'), True)
@@ -10,39 +10,64 @@ anything but tests.
 See https://eprint.iacr.org/2018/068.pdf for the MuSig signature scheme implemented here.
 """
 
+import functools
 import hashlib
 
 from .key import (
+    ECPubKey,
     SECP256K1,
     SECP256K1_ORDER,
-    TaggedHash,
 )
 
+# SHA256 state with the BIP0340/challenge tagged hash prefix already absorbed
+_BIP340_CHALLENGE_TAG = hashlib.sha256(b"BIP0340/challenge").digest()
+BIP340_CHALLENGE_MIDSTATE = hashlib.sha256(_BIP340_CHALLENGE_TAG + _BIP340_CHALLENGE_TAG)
+
+# Window width for the precomputed per-participant tables
+MUSIG_TABLE_WINDOW = 5
+
+# Number of participant tables kept around for reuse
+MUSIG_TABLE_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize=MUSIG_TABLE_CACHE_SIZE)
+def _musig_table(p):
+    """Return the (cached) table of odd multiples of the affine pubkey point p."""
+    return SECP256K1.odd_multiples(p, MUSIG_TABLE_WINDOW)
+
 def generate_musig_key(pubkey_list):
     """Aggregate individually generated public keys.
 
     Returns a MuSig public key as defined in the MuSig paper."""
-    pubkey_list_sorted = sorted([int.from_bytes(key.get_bytes(), 'big') for key in pubkey_list])
-    L = b''
-    for px in pubkey_list_sorted:
-        L += px.to_bytes(32, 'big')
+    pubkey_bytes = [key.get_bytes() for key in pubkey_list]
+    # Sorting the 32-byte big-endian encodings is equivalent to sorting the x coordinates
+    L = b''.join(sorted(pubkey_bytes))
     Lh = hashlib.sha256(L).digest()
+    Lh_hasher = hashlib.sha256(Lh)
     musig_c = {}
-    aggregate_key = 0
-    for key in pubkey_list:
-        musig_c[key] = hashlib.sha256(Lh + key.get_bytes()).digest()
-        aggregate_key += key.mul(musig_c[key])
+    for key, key_bytes in zip(pubkey_list, pubkey_bytes):
+        h = Lh_hasher.copy()
+        h.update(key_bytes)
+        musig_c[key] = h.digest()
+    # Compute sum(c_i * P_i) as a single multi-point multiplication, so that
+    # the doublings are shared between all participants.
+    aggregate_key = ECPubKey()
+    aggregate_key.p = SECP256K1.mul_with_tables([(_musig_table(key.get_affine()), int.from_bytes(musig_c[key], 'big') % SECP256K1_ORDER) for key in pubkey_list])
+    aggregate_key.valid = True
+    aggregate_key.compressed = pubkey_list[0].compressed
     return musig_c, aggregate_key
 
 def aggregate_schnorr_nonces(nonce_point_list):
     """Construct aggregated musig nonce from individually generated nonces."""
-    R_agg = sum(nonce_point_list)
-    R_agg_affine = SECP256K1.affine(R_agg.p)
+    R_agg = ECPubKey()
+    # The parity of y is only defined in affine coordinates. Keep the affine
+    # form so that later serializations don't need another inversion.
+    R_agg.p = SECP256K1.affine(SECP256K1.sum_points([R.p for R in nonce_point_list]))
+    R_agg.valid = True
+    R_agg.compressed = nonce_point_list[0].compressed
     negated = False
-    if R_agg_affine[1] % 2 != 0:
+    if R_agg.p[1] % 2 != 0:
         negated = True
-        R_agg_negated = SECP256K1.mul([(R_agg.p, SECP256K1_ORDER - 1)])
-        R_agg.p = R_agg_negated
+        R_agg.p = SECP256K1.negate(R_agg.p)
     return R_agg, negated
 
 def sign_musig(priv_key, k_key, R_musig, P_musig, msg):
@@ -58,10 +83,14 @@ def sign_musig(priv_key, k_key, R_musig, P_musig, msg):
 
 def musig_digest(R_musig, P_musig, msg):
     """Get the digest to sign for musig"""
-    return int.from_bytes(TaggedHash("BIP0340/challenge", R_musig.get_bytes() + P_musig.get_bytes() + msg), 'big') % SECP256K1_ORDER
+    h = BIP340_CHALLENGE_MIDSTATE.copy()
+    h.update(R_musig.get_bytes())
+    h.update(P_musig.get_bytes())
+    h.update(msg)
+    return int.from_bytes(h.digest(), 'big') % SECP256K1_ORDER
 
 def aggregate_musig_signatures(s_list, R_musig):
     """Construct valid Schnorr signature from a list of partial MuSig signatures."""
     assert s_list is not None and all(isinstance(s, int) for s in s_list)
     s_agg = sum(s_list) % SECP256K1_ORDER
-    return R_musig.get_x().to_bytes(32, 'big') + s_agg.to_bytes(32, 'big')
+    return R_musig.get_bytes() + s_agg.to_bytes(32, 'big')
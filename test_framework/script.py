@@ -7,13 +7,15 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .messages import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string, CTxInWitness
-from .key import ECKey, ECPubKey
+from .messages import CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_compact_size, ser_string, CTxInWitness
+from .key import ECKey, ECPubKey, _TAG_MIDSTATES, _tagged_hash_midstate
 
 import binascii
+import functools
 import hashlib
+import heapq
 import itertools
-import queue
+import re
 import struct
 
 from .bignum import bn2vch
@@ -33,7 +35,22 @@ def hash160(s):
     return hashlib.new('ripemd160', sha256(s)).digest()
 
 
-_opcode_instances = []
+# Opcode properties, indexed by opcode
+_IS_SMALL_INT = bytes(1 if (0x51 <= o <= 0x60 or o == 0) else 0 for o in range(256))
+_DECODE_OP_N = bytes(o - 0x50 if 0x51 <= o <= 0x60 else 0 for o in range(256))
+
+# Precompiled little-endian integer packers
+_PACK_LE_H = struct.Struct("<H").pack
+_PACK_LE_I = struct.Struct("<I").pack
+_PACK_LE_i = struct.Struct("<i").pack
+_PACK_LE_q = struct.Struct("<q").pack
+
+_ZERO1 = b"\x00"
+_ZERO32 = bytes(32)
+
+# Single byte encodings, indexed by value
+_OP_BYTES = tuple(bytes((o,)) for o in range(256))
+
 class CScriptOp(int):
     """A single script opcode"""
     __slots__ = ()
@@ -42,13 +59,13 @@ class CScriptOp(int):
     def encode_op_pushdata(d):
         """Encode a PUSHDATA op, returning bytes"""
         if len(d) < 0x4c:
-            return b'' + bytes([len(d)]) + d # OP_PUSHDATA
+            return _OP_BYTES[len(d)] + d # OP_PUSHDATA
         elif len(d) <= 0xff:
-            return b'\x4c' + bytes([len(d)]) + d # OP_PUSHDATA1
+            return b'\x4c' + _OP_BYTES[len(d)] + d # OP_PUSHDATA1
         elif len(d) <= 0xffff:
-            return b'\x4d' + struct.pack(b'<H', len(d)) + d # OP_PUSHDATA2
+            return b'\x4d' + _PACK_LE_H(len(d)) + d # OP_PUSHDATA2
         elif len(d) <= 0xffffffff:
-            return b'\x4e' + struct.pack(b'<I', len(d)) + d # OP_PUSHDATA4
+            return b'\x4e' + _PACK_LE_I(len(d)) + d # OP_PUSHDATA4
         else:
             raise ValueError("Data too long to encode in a PUSHDATA op")
 
@@ -65,41 +82,26 @@ class CScriptOp(int):
 
     def decode_op_n(self):
         """Decode a small integer opcode, returning an integer"""
-        if self == OP_0:
-            return 0
-
-        if not (self == OP_0 or OP_1 <= self <= OP_16):
+        if not _IS_SMALL_INT[self]:
             raise ValueError('op %r is not an OP_N' % self)
 
-        return int(self - OP_1+1)
+        return _DECODE_OP_N[self]
 
     def is_small_int(self):
         """Return true if the op pushes a small integer to the stack"""
-        if 0x51 <= self <= 0x60 or self == 0:
-            return True
-        else:
-            return False
+        return _IS_SMALL_INT[self] != 0
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
-        if self in OPCODE_NAMES:
-            return OPCODE_NAMES[self]
-        else:
-            return 'CScriptOp(0x%x)' % self
+        return _OPCODE_NAME_TABLE[self]
 
     def __new__(cls, n):
-        try:
-            return _opcode_instances[n]
-        except IndexError:
-            assert len(_opcode_instances) == n
-            _opcode_instances.append(super(CScriptOp, cls).__new__(cls, n))
-            return _opcode_instances[n]
+        return _opcode_instances[n]
 
-# Populate opcode instance table
-for n in range(0xff+1):
-    CScriptOp(n)
+# Opcode instance table, so that CScriptOp(n) never allocates
+_opcode_instances = tuple(int.__new__(CScriptOp, n) for n in range(0xff+1))
 
 
 # push value
@@ -355,6 +357,15 @@ OPCODE_NAMES.update({
     OP_INVALIDOPCODE : 'OP_INVALIDOPCODE',
 })
 
+# Signature operations counted by GetSigOpCount, indexed by opcode: 1 for
+# single signature checks, 2 for multisig checks
+_SIGOP_KIND = bytearray(256)
+_SIGOP_KIND[OP_CHECKSIG] = _SIGOP_KIND[OP_CHECKSIGVERIFY] = 1
+_SIGOP_KIND[OP_CHECKMULTISIG] = _SIGOP_KIND[OP_CHECKMULTISIGVERIFY] = 2
+
+# Opcode names indexed by opcode, for CScriptOp.__repr__
+_OPCODE_NAME_TABLE = tuple(OPCODE_NAMES.get(o, 'CScriptOp(0x%x)' % o) for o in range(256))
+
 class CScriptInvalidError(Exception):
     """Base class for CScript exceptions"""
     pass
@@ -375,14 +386,11 @@ class CScriptNum:
 
     @staticmethod
     def encode(obj):
-        r = bytearray(0)
         if obj.value == 0:
-            return bytes(r)
+            return b''
         neg = obj.value < 0
         absvalue = -obj.value if neg else obj.value
-        while (absvalue):
-            r.append(absvalue & 0xff)
-            absvalue >>= 8
+        r = bytearray(absvalue.to_bytes((absvalue.bit_length() + 7) // 8, 'little'))
         if r[-1] & 0x80:
             r.append(0x80 if neg else 0)
         elif neg:
@@ -391,13 +399,11 @@ class CScriptNum:
 
     @staticmethod
     def decode(vch):
-        result = 0
         # We assume valid push_size and minimal encoding
         value = vch[1:]
         if len(value) == 0:
-            return result
-        for i, byte in enumerate(value):
-            result |= int(byte) << 8*i
+            return 0
+        result = int.from_bytes(value, 'little')
         if value[-1] >= 0x80:
             # Mask for all but the highest result bit
             num_mask = (2**(len(value)*8) - 1) >> 1
@@ -422,17 +428,17 @@ class CScript(bytes):
     def __coerce_instance(cls, other):
         # Coerce other into bytes
         if isinstance(other, CScriptOp):
-            other = bytes([other])
+            other = _OP_BYTES[other]
         elif isinstance(other, CScriptNum):
             if (other.value == 0):
-                other = bytes([CScriptOp(OP_0)])
+                other = _OP_BYTES[OP_0]
             else:
                 other = CScriptNum.encode(other)
         elif isinstance(other, int):
             if 0 <= other <= 16:
-                other = bytes([CScriptOp.encode_op_n(other)])
+                other = _OP_BYTES[CScriptOp.encode_op_n(other)]
             elif other == -1:
-                other = bytes([OP_1NEGATE])
+                other = _OP_BYTES[OP_1NEGATE]
             else:
                 other = CScriptOp.encode_op_pushdata(bn2vch(other))
         elif isinstance(other, (bytes, bytearray)):
@@ -473,7 +479,8 @@ class CScript(bytes):
         determining the exact opcode byte indexes. (sop_idx)
         """
         i = 0
-        while i < len(self):
+        n = len(self)
+        while i < n:
             sop_idx = i
             opcode = self[i]
             i += 1
@@ -489,30 +496,31 @@ class CScript(bytes):
 
                 elif opcode == OP_PUSHDATA1:
                     pushdata_type = 'PUSHDATA1'
-                    if i >= len(self):
+                    if i >= n:
                         raise CScriptInvalidError('PUSHDATA1: missing data length')
                     datasize = self[i]
                     i += 1
 
                 elif opcode == OP_PUSHDATA2:
                     pushdata_type = 'PUSHDATA2'
-                    if i + 1 >= len(self):
+                    if i + 1 >= n:
                         raise CScriptInvalidError('PUSHDATA2: missing data length')
-                    datasize = self[i] + (self[i+1] << 8)
+                    datasize = int.from_bytes(self[i:i+2], 'little')
                     i += 2
 
                 elif opcode == OP_PUSHDATA4:
                     pushdata_type = 'PUSHDATA4'
-                    if i + 3 >= len(self):
+                    if i + 3 >= n:
                         raise CScriptInvalidError('PUSHDATA4: missing data length')
-                    datasize = self[i] + (self[i+1] << 8) + (self[i+2] << 16) + (self[i+3] << 24)
+                    datasize = int.from_bytes(self[i:i+4], 'little')
                     i += 4
 
                 else:
                     assert False # shouldn't happen
 
 
-                data = bytes(self[i:i+datasize])
+                # Slicing a bytes subclass already returns a new bytes object
+                data = self[i:i+datasize]
 
                 # Check for truncation
                 if len(data) < datasize:
@@ -522,6 +530,51 @@ class CScript(bytes):
 
                 yield (opcode, data, sop_idx)
 
+    def raw_iter_opcodes_only(self):
+        """Raw iteration over opcodes only
+
+        Like raw_iter(), but yields tuples of (opcode, sop_idx) and skips over
+        pushed data without copying it. Raises the same errors as raw_iter()
+        for invalid scripts.
+        """
+        i = 0
+        n = len(self)
+        while i < n:
+            sop_idx = i
+            opcode = self[i]
+            i += 1
+
+            if opcode <= OP_PUSHDATA4:
+                if opcode < OP_PUSHDATA1:
+                    pushdata_type = 'PUSHDATA(%d)' % opcode
+                    datasize = opcode
+                elif opcode == OP_PUSHDATA1:
+                    pushdata_type = 'PUSHDATA1'
+                    if i >= n:
+                        raise CScriptInvalidError('PUSHDATA1: missing data length')
+                    datasize = self[i]
+                    i += 1
+                elif opcode == OP_PUSHDATA2:
+                    pushdata_type = 'PUSHDATA2'
+                    if i + 1 >= n:
+                        raise CScriptInvalidError('PUSHDATA2: missing data length')
+                    datasize = int.from_bytes(self[i:i+2], 'little')
+                    i += 2
+                else:
+                    pushdata_type = 'PUSHDATA4'
+                    if i + 3 >= n:
+                        raise CScriptInvalidError('PUSHDATA4: missing data length')
+                    datasize = int.from_bytes(self[i:i+4], 'little')
+                    i += 4
+
+                # Check for truncation
+                if i + datasize > n:
+                    raise CScriptTruncatedPushDataError('%s: truncated data' % pushdata_type, self[i:])
+
+                i += datasize
+
+            yield (opcode, sop_idx)
+
     def __iter__(self):
         """'Cooked' iteration
 
@@ -578,12 +631,13 @@ class CScript(bytes):
         """
         n = 0
         lastOpcode = OP_INVALIDOPCODE
-        for (opcode, data, sop_idx) in self.raw_iter():
-            if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+        for (opcode, sop_idx) in self.raw_iter_opcodes_only():
+            kind = _SIGOP_KIND[opcode]
+            if kind == 1:
                 n += 1
-            elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+            elif kind == 2:
                 if fAccurate and (OP_1 <= lastOpcode <= OP_16):
-                    n += opcode.decode_op_n()
+                    n += _DECODE_OP_N[lastOpcode]
                 else:
                     n += 20
             lastOpcode = opcode
@@ -598,20 +652,16 @@ SIGHASH_ANYONECANPAY = 0x80
 
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
-    r = b''
-    last_sop_idx = sop_idx = 0
-    skip = True
-    for (opcode, data, sop_idx) in script.raw_iter():
-        if not skip:
-            r += script[last_sop_idx:sop_idx]
-        last_sop_idx = sop_idx
-        if script[sop_idx:sop_idx + len(sig)] == sig:
-            skip = True
-        else:
-            skip = False
-    if not skip:
-        r += script[last_sop_idx:]
-    return CScript(r)
+    # Every opcode (including its pushed data) that starts with sig is removed.
+    boundaries = [sop_idx for (opcode, sop_idx) in script.raw_iter_opcodes_only()]
+    matches = set()
+    i = script.find(sig)
+    while i != -1:
+        matches.add(i)
+        i = script.find(sig, i + 1)
+    boundaries.append(len(script))
+    kept = [script[start:end] for start, end in zip(boundaries, boundaries[1:]) if start not in matches]
+    return CScript(b''.join(kept))
 
 def IsPayToScriptHash(script):
     return len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL
@@ -620,10 +670,37 @@ def IsPayToTaproot(script):
     return len(script) == 34 and script[0] == OP_1 and script[1] == 32
 
 def tagged_hash(tag, data):
-    ss = sha256(tag.encode('utf-8'))
-    ss += ss
-    ss += data
-    return sha256(ss)
+    midstate = _TAG_MIDSTATES.get(tag)
+    if midstate is None:
+        midstate = _tagged_hash_midstate(tag)
+    h = midstate.copy()
+    h.update(data)
+    return h.digest()
+
+def _make_tagged_hash(tag):
+    """Return a function computing tagged_hash(tag, data) for a fixed tag."""
+    midstate = _TAG_MIDSTATES[tag]
+    def tagged_hash_fixed(data):
+        h = midstate.copy()
+        h.update(data)
+        return h.digest()
+    return tagged_hash_fixed
+
+tagged_hash_tapleaf = _make_tagged_hash("TapLeaf")
+tagged_hash_tapbranch = _make_tagged_hash("TapBranch")
+tagged_hash_taptweak = _make_tagged_hash("TapTweak")
+tagged_hash_tapsighash = _make_tagged_hash("TapSighash")
+
+def tapleaf_hash(leaf_ver, script):
+    """Compute the TapLeaf hash of a script, with leaf_ver as the version byte.
+
+    Equivalent to tagged_hash_tapleaf(bytes([leaf_ver]) + ser_string(script)),
+    without building the serialized leaf."""
+    h = _TAG_MIDSTATES["TapLeaf"].copy()
+    h.update(_OP_BYTES[leaf_ver])
+    h.update(ser_compact_size(len(script)))
+    h.update(script)
+    return h.digest()
 
 def GetP2SH(script):
     return CScript([OP_HASH160, hash160(script), OP_EQUAL])
@@ -638,41 +715,52 @@ def LegacySignatureHash(script, txTo, inIdx, hashtype):
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
+    # Rather than copying the whole transaction, modify it in place and put
+    # the original inputs, outputs and sequence numbers back afterwards.
+    orig_vin = txTo.vin
+    orig_vout = txTo.vout
+    orig_scriptsigs = [txin.scriptSig for txin in orig_vin]
+    orig_seqs = [txin.nSequence for txin in orig_vin]
+    try:
+        for txin in txTo.vin:
+            txin.scriptSig = b''
+        txTo.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
+
+        if (hashtype & 0x1f) == SIGHASH_NONE:
+            txTo.vout = []
+
+            for i in range(len(txTo.vin)):
+                if i != inIdx:
+                    txTo.vin[i].nSequence = 0
+
+        elif (hashtype & 0x1f) == SIGHASH_SINGLE:
+            outIdx = inIdx
+            if outIdx >= len(txTo.vout):
+                return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txTo.vout)))
+
+            tmp = txTo.vout[outIdx]
+            txTo.vout = []
+            for i in range(outIdx):
+                txTo.vout.append(CTxOut(-1))
+            txTo.vout.append(tmp)
+
+            for i in range(len(txTo.vin)):
+                if i != inIdx:
+                    txTo.vin[i].nSequence = 0
+
+        if hashtype & SIGHASH_ANYONECANPAY:
+            tmp = txTo.vin[inIdx]
+            txTo.vin = []
+            txTo.vin.append(tmp)
+
+        s = txTo.serialize_without_witness()
+    finally:
+        txTo.vin = orig_vin
+        txTo.vout = orig_vout
+        for txin, scriptSig, nSequence in zip(orig_vin, orig_scriptsigs, orig_seqs):
+            txin.scriptSig = scriptSig
+            txin.nSequence = nSequence
+    s += _PACK_LE_I(hashtype)
 
     hash = hash256(s)
 
@@ -682,93 +770,173 @@ def get_p2pkh_script(pubkeyhash):
     """Get the script associated with a P2PKH."""
     return CScript([CScriptOp(OP_DUP), CScriptOp(OP_HASH160), pubkeyhash, CScriptOp(OP_EQUALVERIFY), CScriptOp(OP_CHECKSIG)])
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
+class PrecomputedTransactionData:
+    """Transaction-wide hashes shared by the signature hashes of all inputs
+
+    See PrecomputedTransactionData in Bitcoin Core. Computing these once and
+    passing them to SegwitV0SignatureHash() or TaprootSignatureHash() avoids
+    rehashing all inputs and outputs of the transaction for every input. The
+    transaction (and spent outputs) must not be modified afterwards.
+
+    spent_utxos is only needed for taproot signature hashes."""
+
+    def __init__(self, txTo, spent_utxos=None):
+        self.prevouts_single_hash = sha256(b"".join([i.prevout.serialize() for i in txTo.vin]))
+        self.sequences_single_hash = sha256(b"".join([_PACK_LE_I(i.nSequence) for i in txTo.vin]))
+        self.outputs_single_hash = sha256(b"".join([o.serialize() for o in txTo.vout]))
+        if spent_utxos is not None:
+            assert len(txTo.vin) == len(spent_utxos)
+            self.spent_amounts_single_hash = sha256(b"".join([_PACK_LE_q(u.nValue) for u in spent_utxos]))
+            self.spent_scripts_single_hash = sha256(b"".join([ser_string(u.scriptPubKey) for u in spent_utxos]))
+        # Segwit v0 signature hashes use the double SHA256 of the same data
+        self.hashPrevouts = uint256_from_str(sha256(self.prevouts_single_hash))
+        self.hashSequence = uint256_from_str(sha256(self.sequences_single_hash))
+        self.hashOutputs = uint256_from_str(sha256(self.outputs_single_hash))
+
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitV0SignatureHash(script, txTo, inIdx, hashtype, amount):
+def SegwitV0SignatureHash(script, txTo, inIdx, hashtype, amount, txdata=None):
 
     hashPrevouts = 0
     hashSequence = 0
     hashOutputs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        if txdata is not None:
+            hashPrevouts = txdata.hashPrevouts
+        else:
+            serialize_prevouts = b"".join(i.prevout.serialize() for i in txTo.vin)
+            hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        if txdata is not None:
+            hashSequence = txdata.hashSequence
+        else:
+            serialize_sequence = b"".join(_PACK_LE_I(i.nSequence) for i in txTo.vin)
+            hashSequence = uint256_from_str(hash256(serialize_sequence))
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        if txdata is not None:
+            hashOutputs = txdata.hashOutputs
+        else:
+            serialize_outputs = b"".join(o.serialize() for o in txTo.vout)
+            hashOutputs = uint256_from_str(hash256(serialize_outputs))
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
         hashOutputs = uint256_from_str(hash256(serialize_outputs))
 
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
+    ss = b"".join([
+        _PACK_LE_i(txTo.nVersion),
+        ser_uint256(hashPrevouts),
+        ser_uint256(hashSequence),
+        txTo.vin[inIdx].prevout.serialize(),
+        ser_string(script),
+        _PACK_LE_q(amount),
+        _PACK_LE_I(txTo.vin[inIdx].nSequence),
+        ser_uint256(hashOutputs),
+        _PACK_LE_i(txTo.nLockTime),
+        _PACK_LE_I(hashtype),
+    ])
 
     return hash256(ss)
 
-def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
-    assert (len(txTo.vin) == len(spent_utxos))
-    assert (input_index < len(txTo.vin))
+def _taproot_sighash_length(hash_type, annex, scriptpath):
+    """Return the expected length of the BIP341 signature message."""
     out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
     in_type = hash_type & SIGHASH_ANYONECANPAY
-    spk = spent_utxos[input_index].scriptPubKey
-    ss = bytes([0, hash_type]) # epoch, hash_type
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += struct.pack("<I", txTo.nLockTime)
+    return 175 - (in_type == SIGHASH_ANYONECANPAY) * 49 - (out_type != SIGHASH_ALL and out_type != SIGHASH_SINGLE) * 32 + (annex is not None) * 32 + scriptpath * 37
+
+def _taproot_sighash_prefix(txTo, spent_utxos, hash_type, txdata):
+    """Return the part of the BIP341 signature message that is the same for all inputs."""
+    out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
+    in_type = hash_type & SIGHASH_ANYONECANPAY
+    parts = [bytes([0, hash_type])] # epoch, hash_type
+    parts.append(_PACK_LE_i(txTo.nVersion))
+    parts.append(_PACK_LE_I(txTo.nLockTime))
+    # Input and output hashes are only computed when hash_type commits to them.
     if in_type != SIGHASH_ANYONECANPAY:
-        ss += sha256(b"".join(i.prevout.serialize() for i in txTo.vin))
-        ss += sha256(b"".join(struct.pack("<q", u.nValue) for u in spent_utxos))
-        ss += sha256(b"".join(ser_string(u.scriptPubKey) for u in spent_utxos))
-        ss += sha256(b"".join(struct.pack("<I", i.nSequence) for i in txTo.vin))
+        if txdata is not None:
+            parts.append(txdata.prevouts_single_hash)
+            parts.append(txdata.spent_amounts_single_hash)
+            parts.append(txdata.spent_scripts_single_hash)
+            parts.append(txdata.sequences_single_hash)
+        else:
+            parts.append(sha256(b"".join([i.prevout.serialize() for i in txTo.vin])))
+            parts.append(sha256(b"".join([_PACK_LE_q(u.nValue) for u in spent_utxos])))
+            parts.append(sha256(b"".join([ser_string(u.scriptPubKey) for u in spent_utxos])))
+            parts.append(sha256(b"".join([_PACK_LE_I(i.nSequence) for i in txTo.vin])))
     if out_type == SIGHASH_ALL:
-        ss += sha256(b"".join(o.serialize() for o in txTo.vout))
+        if txdata is not None:
+            parts.append(txdata.outputs_single_hash)
+        else:
+            parts.append(sha256(b"".join([o.serialize() for o in txTo.vout])))
+    return b"".join(parts)
+
+def _taproot_sighash_input(txTo, spent_utxos, hash_type, input_index, scriptpath, script, codeseparator_pos, annex, leaf_ver):
+    """Return the input specific part of the BIP341 signature message."""
+    out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
+    in_type = hash_type & SIGHASH_ANYONECANPAY
+    spk = spent_utxos[input_index].scriptPubKey
     spend_type = 0
     if annex is not None:
         spend_type |= 1
     if (scriptpath):
         spend_type |= 2
-    ss += bytes([spend_type])
+    parts = [bytes([spend_type])]
     if in_type == SIGHASH_ANYONECANPAY:
-        ss += txTo.vin[input_index].prevout.serialize()
-        ss += struct.pack("<q", spent_utxos[input_index].nValue)
-        ss += ser_string(spk)
-        ss += struct.pack("<I", txTo.vin[input_index].nSequence)
+        parts.append(txTo.vin[input_index].prevout.serialize())
+        parts.append(_PACK_LE_q(spent_utxos[input_index].nValue))
+        parts.append(ser_string(spk))
+        parts.append(_PACK_LE_I(txTo.vin[input_index].nSequence))
     else:
-        ss += struct.pack("<I", input_index)
+        parts.append(_PACK_LE_I(input_index))
     if (spend_type & 1):
-        ss += sha256(ser_string(annex))
+        parts.append(sha256(ser_string(annex)))
     if out_type == SIGHASH_SINGLE:
         if input_index < len(txTo.vout):
-            ss += sha256(txTo.vout[input_index].serialize())
+            parts.append(sha256(txTo.vout[input_index].serialize()))
         else:
-            ss += bytes(0 for _ in range(32))
+            parts.append(_ZERO32)
     if (scriptpath):
-        ss += tagged_hash("TapLeaf", bytes([leaf_ver]) + ser_string(script))
-        ss += bytes([0])
-        ss += struct.pack("<i", codeseparator_pos)
-    assert len(ss) ==  175 - (in_type == SIGHASH_ANYONECANPAY) * 49 - (out_type != SIGHASH_ALL and out_type != SIGHASH_SINGLE) * 32 + (annex is not None) * 32 + scriptpath * 37
-    return tagged_hash("TapSighash", ss)
+        parts.append(tapleaf_hash(leaf_ver, script))
+        parts.append(_ZERO1)
+        parts.append(_PACK_LE_i(codeseparator_pos))
+    return b"".join(parts)
+
+def TaprootSignatureHash(txTo, spent_utxos, hash_type, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT, txdata = None):
+    """Compute the BIP341 signature hash of an input
+
+    txdata is an optional PrecomputedTransactionData for txTo and spent_utxos."""
+    assert (len(txTo.vin) == len(spent_utxos))
+    assert (input_index < len(txTo.vin))
+    ss = _taproot_sighash_prefix(txTo, spent_utxos, hash_type, txdata)
+    ss += _taproot_sighash_input(txTo, spent_utxos, hash_type, input_index, scriptpath, script, codeseparator_pos, annex, leaf_ver)
+    assert len(ss) == _taproot_sighash_length(hash_type, annex, scriptpath)
+    return tagged_hash_tapsighash(ss)
+
+def TaprootSignatureHashBatch(txTo, spent_utxos, hash_type, input_indices = None, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT, txdata = None):
+    """Compute the BIP341 signature hashes of several inputs of the same transaction
+
+    Returns a list with the signature hash of each input in input_indices
+    (all inputs by default), as TaprootSignatureHash() would compute them
+    with the same remaining arguments. The part of the signature message
+    shared by all inputs is only built and hashed once."""
+    assert (len(txTo.vin) == len(spent_utxos))
+    if input_indices is None:
+        input_indices = range(len(txTo.vin))
+    prefix_data = _taproot_sighash_prefix(txTo, spent_utxos, hash_type, txdata)
+    expected_input_len = _taproot_sighash_length(hash_type, annex, scriptpath) - len(prefix_data)
+    prefix = _TAG_MIDSTATES["TapSighash"].copy()
+    prefix.update(prefix_data)
+    sighashes = []
+    for input_index in input_indices:
+        assert (input_index < len(txTo.vin))
+        input_data = _taproot_sighash_input(txTo, spent_utxos, hash_type, input_index, scriptpath, script, codeseparator_pos, annex, leaf_ver)
+        assert len(input_data) == expected_input_len
+        h = prefix.copy()
+        h.update(input_data)
+        sighashes.append(h.digest())
+    return sighashes
 
 def GetVersionTaggedPubKey(pubkey, version, tweaked_pubkey):
     assert pubkey.is_valid
@@ -779,26 +947,38 @@ def GetVersionTaggedPubKey(pubkey, version, tweaked_pubkey):
     parity_bit = tweaked_pubkey.get_y()%2
     return bytes([parity_bit & 0x01 | version]) + data
 
-def taproot_tree_helper(scripts):
+def _taproot_tree_proofs(scripts, leaves):
+    """Append (version, script, proof) for every leaf under scripts to leaves and return the subtree hash.
+
+    proof is a list of the sibling hashes on the path from the leaf to the
+    root, which is extended in place as the tree is built."""
     if len(scripts) == 1:
         script = scripts[0]
         if isinstance(script, list):
-            return taproot_tree_helper(script)
+            return _taproot_tree_proofs(script, leaves)
         version = DEFAULT_TAPSCRIPT_VER
         if isinstance(script, tuple):
             version, script = script
         assert isinstance(script, bytes)
-        h = tagged_hash("TapLeaf", bytes([version & 0xfe]) + ser_string(script))
-        return ([(version, script, bytes())], h)
+        leaves.append((version, script, []))
+        return tapleaf_hash(version & 0xfe, script)
     split_pos = len(scripts) // 2
-    left, left_h = taproot_tree_helper(scripts[0:split_pos])
-    right, right_h = taproot_tree_helper(scripts[split_pos:])
-    left = [(version, script, control + right_h) for version, script, control in left]
-    right = [(version, script, control + left_h) for version, script, control in right]
+    start = len(leaves)
+    left_h = _taproot_tree_proofs(scripts[0:split_pos], leaves)
+    mid = len(leaves)
+    right_h = _taproot_tree_proofs(scripts[split_pos:], leaves)
+    for i in range(start, mid):
+        leaves[i][2].append(right_h)
+    for i in range(mid, len(leaves)):
+        leaves[i][2].append(left_h)
     if right_h < left_h:
         right_h, left_h = left_h, right_h
-    h = tagged_hash("TapBranch", left_h + right_h)
-    return (left + right, h)
+    return tagged_hash_tapbranch(left_h + right_h)
+
+def taproot_tree_helper(scripts):
+    leaves = []
+    h = _taproot_tree_proofs(scripts, leaves)
+    return ([(version, script, b"".join(proof)) for version, script, proof in leaves], h)
 
 def taproot_construct(pubkey, scripts=[]):
     """Construct a tree of taproot spending conditions
@@ -811,17 +991,20 @@ def taproot_construct(pubkey, scripts=[]):
 
     Returns: script (sPK or redeemScript), tweak, {script:control, ...}
     """
-    tweak = tagged_hash("TapTweak", pubkey.get_bytes() + h)
+    tweak = tagged_hash_taptweak(pubkey.get_bytes() + h)
     tweaked = pubkey.tweak_add(tweak)
     if len(scripts) == 0:
-        return (CScript([OP_1, GetVersionTaggedPubKey(pubkey, TAPROOT_VER, tweaked)]), bytes([0 for i in range(32)]), {})
+        return (CScript([OP_1, GetVersionTaggedPubKey(pubkey, TAPROOT_VER, tweaked)]), _ZERO32, {})
 
     ret, h = taproot_tree_helper(scripts)
     control_map = dict((script, GetVersionTaggedPubKey(pubkey, version, tweaked) + control) for version, script, control in ret)
     return (CScript([OP_1, GetVersionTaggedPubKey(tweaked, TAPROOT_VER, tweaked)]), tweak, control_map)
 
+# OP_SUCCESSx opcodes, indexed by opcode
+_OP_SUCCESS = bytes(1 if (o == 0x50 or o == 0x62 or o == 0x89 or o == 0x8a or o == 0x8d or o == 0x8e or (o >= 0x7e and o <= 0x81) or (o >= 0x83 and o <= 0x86) or (o >= 0x95 and o <= 0x99) or (o >= 0xbb and o <= 0xfe)) else 0 for o in range(256))
+
 def is_op_success(o):
-    return o == 0x50 or o == 0x62 or o == 0x89 or o == 0x8a or o == 0x8d or o == 0x8e or (o >= 0x7e and o <= 0x81) or (o >= 0x83 and o <= 0x86) or (o >= 0x95 and o <= 0x99) or (o >= 0xbb and o <= 0xfe)
+    return bool(_OP_SUCCESS[o])
 
 def IsPayToPubkey(script):
     pk = ECPubKey()
@@ -834,28 +1017,39 @@ def IsCheckSigAdd(script):
     else:
         return False
 
+# Characters delimiting the structure of taptree and miniscript descriptors
+_TREE_DELIMITERS = re.compile(r'[\[\](),]')
+_MINISCRIPT_DELIMITERS = re.compile(r'[():,]')
+
 def ParseDesc(desc, tag, op, cl):
     op_tag = tag+op
     assert(desc[:len(op_tag)] == op_tag)
     desc = desc[len(op_tag):-1]
-    depth = 0
-    for t in desc:
-        if t == op:
-            depth += 1
-        if t == cl:
-            depth -= 1
-    if depth == 0:
+    # The delimiters are balanced if they occur equally often.
+    if desc.count(op) == desc.count(cl):
         return desc
     else:
         # Malformed descriptor.
         raise Exception
 
+# Number of validated descriptor keys kept around for reuse
+TAPLEAF_KEY_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=TAPLEAF_KEY_CACHE_SIZE)
+def _key_bytes_from_hex(key_string):
+    """Return the (cached) 32-byte encoding of a hex public key, checking that it is valid."""
+    pk = ECPubKey()
+    pk.set(bytes.fromhex(key_string))
+    return pk.get_bytes()
+
 class TapLeaf:
     def __init__(self, desc=None, version=DEFAULT_TAPSCRIPT_VER):
         self.version = version
         self.script = None
         self.miniscript = None
         self.sat = None
+        self._cached_hash = None
+        self._cached_hash_key = None
         if desc:
             self.from_desc(desc)
 
@@ -891,15 +1085,27 @@ class TapLeaf:
         return self
 
     def construct_csa(self, k, pkv):
-        keys_data = [key.get_bytes() for key in pkv]
+        return self.construct_csa_bytes(k, [key.get_bytes() for key in pkv])
+
+    def construct_csa_delay(self, k, pkv, delay):
+        return self.construct_csa_delay_bytes(k, [key.get_bytes() for key in pkv], delay)
+
+    def construct_csa_hashlock(self, k, pkv, data):
+        return self.construct_csa_hashlock_bytes(k, [key.get_bytes() for key in pkv], data)
+
+    def construct_csa_hashlock_delay(self, k, pkv, data, delay):
+        return self.construct_csa_hashlock_delay_bytes(k, [key.get_bytes() for key in pkv], data, delay)
+
+    # The construct_csa*_bytes variants take 32-byte x-only public keys
+    # directly, so callers that already hold serialized keys can skip ECPubKey.
+    def construct_csa_bytes(self, k, keys_data):
         thresh_csa_node = miniscript.thresh_csa(k, *keys_data)
         self._set_miniscript(thresh_csa_node)
         keys_string = [data.hex() for data in keys_data]
         self.desc = TapLeaf._desc_serializer('csa', str(k), *keys_string)
         return self
 
-    def construct_csa_delay(self, k, pkv, delay):
-        keys_data = [key.get_bytes() for key in pkv]
+    def construct_csa_delay_bytes(self, k, keys_data, delay):
         thresh_csa_node = miniscript.thresh_csa(k, *keys_data)
         v_thresh_csa_node = miniscript.v(thresh_csa_node)
         older_node = miniscript.older(delay)
@@ -908,8 +1114,7 @@ class TapLeaf:
         self.desc = TapLeaf._desc_serializer('csa_delay', str(k), *keys_string, str(delay))
         return self
 
-    def construct_csa_hashlock(self, k, pkv, data):
-        keys_data = [key.get_bytes() for key in pkv]
+    def construct_csa_hashlock_bytes(self, k, keys_data, data):
         thresh_csa_node = miniscript.thresh_csa(k, *keys_data)
         v_thresh_csa_node = miniscript.v(thresh_csa_node)
         hash_node = miniscript.hash160(data)
@@ -918,8 +1123,7 @@ class TapLeaf:
         self.desc = TapLeaf._desc_serializer('csa_hashlock', str(k), *keys_string, data.hex())
         return self
 
-    def construct_csa_hashlock_delay(self, k, pkv, data, delay):
-        keys_data = [key.get_bytes() for key in pkv]
+    def construct_csa_hashlock_delay_bytes(self, k, keys_data, data, delay):
         thresh_csa_node = miniscript.thresh_csa(k, *keys_data)
         v_thresh_csa_node = miniscript.v(thresh_csa_node)
         hash_node = miniscript.hash160(data)
@@ -932,120 +1136,92 @@ class TapLeaf:
 
     def _set_miniscript(self, miniscript):
         self.miniscript = miniscript
+        self._cached_hash = None
+        self._cached_hash_key = None
         self.script = CScript(self.miniscript.script)
         self.sat = self.miniscript.sat_xy
 
     @staticmethod
     def _desc_serializer(tag, *args):
-        desc = 'ts(' + tag + '('
-        for arg in args[:-1]:
-            desc += arg + ','
-        desc += args[-1] + '))'
-        return desc
+        return 'ts(' + tag + '(' + ','.join(args) + '))'
 
     def from_desc(self,string):
         string = ''.join(string.split())
         tss = ParseDesc(string, 'ts', '(',')')
+        tag = tss[:tss.find('(')]
 
-        if tss[:3] == 'pk(':
-            expr_s = ParseDesc(tss, 'pk' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            self.construct_pk(pk)
-
-        elif tss[:8] == 'pk_delay(':
-            expr_s = ParseDesc(tss, 'pk_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            self.construct_pk_delay(pk, int(args[1]))
-
-        elif tss[:7] == 'pk_hashlock(':
-            expr_s = ParseDesc(tss, 'pk_hashlock' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            data = bytes.fromhex(args[1])
-            self.construct_pk_hashlock(pk, data)
-
-        elif tss[:12] == 'pk_hashlock_delay(':
-            expr_s = ParseDesc(tss, 'pk_hashlock_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            pk = ECPubKey()
-            pk.set(bytes.fromhex(args[0]))
-            data = bytes.fromhex(args[1])
-            self.construct_pk_hashlock_delay(pk, data, int(args[2]))
-
-        elif tss[:4] == 'csa(':
-            expr_s = ParseDesc(tss, 'csa' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            self.construct_csa(k, pkv)
-
-        elif tss[:9] == 'csa_delay(':
-            expr_s = ParseDesc(tss, 'csa_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-1]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            delay = int(args[-1])
-            self.construct_csa_delay(k, pkv, delay)
-
-        elif tss[:8] == 'csa_hashlock(':
-            expr_s = ParseDesc(tss, 'csa_hashlock' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-1]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            data = bytes.fromhex(args[-1])
-            self.construct_csa_hashlock(k, pkv, data)
-
-        elif tss[:13] == 'csa_hashlock_delay(':
-            expr_s = ParseDesc(tss, 'csa_hashlock_delay' ,'(' ,')')
-            args = self._param_parser(expr_s)
-            k = int(args[0])
-            pkv = []
-            for key_string in args[1:-2]:
-                pk = ECPubKey()
-                pk.set(bytes.fromhex(key_string))
-                pkv.append(pk)
-            data = bytes.fromhex(args[-2])
-            delay = int(args[-1])
-            self.construct_csa_hashlock_delay(k, pkv, data, delay)
-
-        elif tss[:4] =='raw(':
+        if tag == 'raw':
             self.script = CScript(binascii.unhexlify(tss[4:-1]))
+            return
 
-        else:
+        from_args = TapLeaf._DESC_PARSERS.get(tag)
+        if from_args is None:
             raise Exception('Tapscript descriptor not recognized.')
+        args = self._param_parser(ParseDesc(tss, tag, '(', ')'))
+        from_args(self, args)
+
+    @staticmethod
+    def _key_from_hex(key_string):
+        pk = ECPubKey()
+        pk.set(bytes.fromhex(key_string))
+        return pk
+
+    @staticmethod
+    def _key_bytes_from_hex(key_string):
+        return _key_bytes_from_hex(key_string)
+
+    def _pk_from_args(self, args):
+        self.construct_pk(TapLeaf._key_from_hex(args[0]))
+
+    def _pk_delay_from_args(self, args):
+        self.construct_pk_delay(TapLeaf._key_from_hex(args[0]), int(args[1]))
+
+    def _pk_hashlock_from_args(self, args):
+        self.construct_pk_hashlock(TapLeaf._key_from_hex(args[0]), bytes.fromhex(args[1]))
+
+    def _pk_hashlock_delay_from_args(self, args):
+        self.construct_pk_hashlock_delay(TapLeaf._key_from_hex(args[0]), bytes.fromhex(args[1]), int(args[2]))
+
+    def _csa_from_args(self, args):
+        keys_data = [TapLeaf._key_bytes_from_hex(key_string) for key_string in args[1:]]
+        self.construct_csa_bytes(int(args[0]), keys_data)
+
+    def _csa_delay_from_args(self, args):
+        keys_data = [TapLeaf._key_bytes_from_hex(key_string) for key_string in args[1:-1]]
+        self.construct_csa_delay_bytes(int(args[0]), keys_data, int(args[-1]))
+
+    def _csa_hashlock_from_args(self, args):
+        keys_data = [TapLeaf._key_bytes_from_hex(key_string) for key_string in args[1:-1]]
+        self.construct_csa_hashlock_bytes(int(args[0]), keys_data, bytes.fromhex(args[-1]))
+
+    def _csa_hashlock_delay_from_args(self, args):
+        keys_data = [TapLeaf._key_bytes_from_hex(key_string) for key_string in args[1:-2]]
+        self.construct_csa_hashlock_delay_bytes(int(args[0]), keys_data, bytes.fromhex(args[-2]), int(args[-1]))
+
+    # Descriptor tag -> method constructing the tapscript from the tag's arguments.
+    _DESC_PARSERS = {
+        'pk': _pk_from_args,
+        'pk_delay': _pk_delay_from_args,
+        'pk_hashlock': _pk_hashlock_from_args,
+        'pk_hashlock_delay': _pk_hashlock_delay_from_args,
+        'csa': _csa_from_args,
+        'csa_delay': _csa_delay_from_args,
+        'csa_hashlock': _csa_hashlock_from_args,
+        'csa_hashlock_delay': _csa_hashlock_delay_from_args,
+    }
 
     @staticmethod
     def _param_parser(expr_string):
-        args = []
-        idx_ = 0
-        expr_string_ = expr_string
-        for idx, ch in enumerate(expr_string):
-            if ch == ',':
-                args.append(expr_string[idx_:idx])
-                idx_ = idx+1
-                expr_string_ = expr_string[idx_:]
-        args.append(expr_string_)
-        return args
+        # Descriptor arguments are keys, hashes and integers, which never nest.
+        return expr_string.split(',')
 
     def tagged_hash(self):
-        return tagged_hash("TapLeaf", bytes([self.version & 0xfe]) + ser_string(self.script))
+        # The leaf hash is needed repeatedly while building trees. Cache it,
+        # recomputing only if the version or script have been replaced.
+        if self._cached_hash_key is None or self._cached_hash_key[0] != self.version or self._cached_hash_key[1] is not self.script:
+            self._cached_hash = tapleaf_hash(self.version & 0xfe, self.script)
+            self._cached_hash_key = (self.version, self.script)
+        return self._cached_hash
 
     def __lt__(self, other):
         return self.tagged_hash() < other.tagged_hash()
@@ -1059,18 +1235,7 @@ class TapLeaf:
             raise Exception
         pubkeys_b = [pubkey.get_bytes() for pubkey in pubkeys]
         pubkeys_b.sort()
-        pubkey_b_sets = list(itertools.combinations(iter(pubkeys_b), k))
-        tapscripts = []
-        for pubkey_b_set in pubkey_b_sets:
-            pubkey_set = []
-            for pubkey_b in pubkey_b_set:
-                pk = ECPubKey()
-                pk.set(pubkey_b)
-                pubkey_set.append(pk)
-            tapscript = TapLeaf()
-            tapscript.construct_csa(k, pubkey_set)
-            tapscripts.append(tapscript)
-        return tapscripts
+        return [TapLeaf().construct_csa_bytes(k, pubkey_b_set) for pubkey_b_set in itertools.combinations(pubkeys_b, k)]
 
 class TapTree:
     def __init__(self, *, key=None, root=None):
@@ -1091,14 +1256,18 @@ class TapTree:
 
     # Tree construction from list(weight(int), TapScript)
     def huffman_constructor(self, tuple_list):
-        p = queue.PriorityQueue()
-        for weight_tapleaf in tuple_list:
-            p.put(weight_tapleaf)
-        while p.qsize() > 1:
-            l, r = p.get(), p.get()
-            node = Tapbranch(l[1], r[1])
-            p.put((l[0]+r[0], node))
-        self.root = p.get()[1]
+        # Nodes of equal weight are ordered by tagged hash. Keep each node's
+        # hash in its heap entry so that ties don't rehash whole subtrees, and
+        # add a sequence number so that nodes themselves are never compared.
+        seq = itertools.count()
+        p = [(weight, tapleaf.tagged_hash(), next(seq), tapleaf) for weight, tapleaf in tuple_list]
+        heapq.heapify(p)
+        while len(p) > 1:
+            l, r = heapq.heappop(p), heapq.heappop(p)
+            node = Tapbranch(l[3], r[3])
+            h = tagged_hash_tapbranch(l[1] + r[1] if l[1] < r[1] else r[1] + l[1])
+            heapq.heappush(p, (l[0]+r[0], h, next(seq), node))
+        self.root = p[0][3]
 
     def set_key(self, data):
         self.key.set(data)
@@ -1106,61 +1275,53 @@ class TapTree:
     @property
     def desc(self):
         assert self.key.valid == True, "Valid internal key must be set."
-        res = 'tp(' +  self.key.get_bytes().hex() + ','
-        res += TapTree._encode_tree(self.root)
-        res += ')'
-        return res
+        return 'tp(' + self.key.get_bytes().hex() + ',' + TapTree._encode_tree(self.root) + ')'
 
     def construct(self):
         assert self.key.valid == True, "Valid internal key must be set."
         ctrl, h = self._constructor(self.root)
-        tweak = tagged_hash("TapTweak", self.key.get_bytes() + h)
+        tweak = tagged_hash_taptweak(self.key.get_bytes() + h)
         tweaked = self.key.tweak_add(tweak)
-        control_map = dict((script, GetVersionTaggedPubKey(self.key, version, tweaked) + control) for version, script, control in ctrl)
+        # The control block prefix only depends on the leaf version.
+        prefixes = {version: GetVersionTaggedPubKey(self.key, version, tweaked) for version in set(version for version, _, _ in ctrl)}
+        control_map = {script: prefixes[version] + control for version, script, control in ctrl}
         return (CScript([OP_1, tweaked.get_bytes()]), tweak, control_map)
 
     @staticmethod
     def _constructor(node):
         if isinstance(node, TapLeaf):
-            h = node.tagged_hash()
-            ctrl = [(node.version, node.script, bytes())]
-            return ctrl, h
-        if isinstance(node.left, TapLeaf):
-            h_l = node.left.tagged_hash()
-            ctrl_l = [(node.left.version, node.left.script, bytes())]
-        else:
-            ctrl_l, h_l  = TapTree._constructor(node.left)
-        if isinstance(node.right, TapLeaf):
-            h_r = node.right.tagged_hash()
-            ctrl_r = [(node.right.version, node.right.script, bytes())]
-        else:
-            ctrl_r, h_r = TapTree._constructor(node.right)
+            return [(node.version, node.script, bytes())], node.tagged_hash()
+        ctrl_l, h_l = TapTree._constructor(node.left)
+        ctrl_r, h_r = TapTree._constructor(node.right)
 
-        ctrl_l = [(version, script, ctrl + h_r) for version, script, ctrl in ctrl_l]
-        ctrl_r = [(version, script, ctrl + h_l) for version, script, ctrl in ctrl_r]
-        if h_r < h_l:
-            h_r, h_l = h_l, h_r
-        h = tagged_hash("TapBranch", h_l + h_r)
-        return (ctrl_l + ctrl_r , h)
+        ctrl_list = [(version, script, ctrl + h_r) for version, script, ctrl in ctrl_l]
+        ctrl_list += [(version, script, ctrl + h_l) for version, script, ctrl in ctrl_r]
+        h = tagged_hash_tapbranch(h_l + h_r if h_l < h_r else h_r + h_l)
+        return (ctrl_list, h)
 
     @staticmethod
     def _encode_tree(node):
-        string = '['
+        parts = []
+        TapTree._encode_tree_parts(node, parts)
+        return ''.join(parts)
+
+    @staticmethod
+    def _encode_tree_parts(node, parts):
+        parts.append('[')
         if isinstance(node, TapLeaf):
-            string += node.desc
-            string += ']'
-            return string
+            parts.append(node.desc)
+            parts.append(']')
+            return
         if isinstance(node.left, TapLeaf):
-            string += node.left.desc
+            parts.append(node.left.desc)
         else:
-            string += TapTree._encode_tree(node.left)
-        string += ','
+            TapTree._encode_tree_parts(node.left, parts)
+        parts.append(',')
         if isinstance(node.right, TapLeaf):
-            string += node.right.desc
+            parts.append(node.right.desc)
         else:
-            string += TapTree._encode_tree(node.right)
-        string += ']'
-        return string
+            TapTree._encode_tree_parts(node.right, parts)
+        parts.append(']')
 
     def _decode_tree(self, string, parent=None):
         l, r = TapTree._parse_tuple(string)
@@ -1186,7 +1347,10 @@ class TapTree:
         ts = ts[1:-1]
         depth = 0
         l, r = None, None
-        for idx, ch in enumerate(ts):
+        # Only visit the delimiters, skipping over keys and other arguments.
+        for m in _TREE_DELIMITERS.finditer(ts):
+            ch = m.group()
+            idx = m.start()
             if depth == 0 and ch == ',':
                 l,r = ts[:idx], ts[idx+1:]
                 break
@@ -1209,7 +1373,8 @@ class Tapbranch():
         self.right = right
 
     def tagged_hash(self):
-        return tagged_hash("TapBranch", b''.join(sorted([self.left.tagged_hash(),self.right.tagged_hash()])))
+        l, r = self.left.tagged_hash(), self.right.tagged_hash()
+        return tagged_hash_tapbranch(l + r if l < r else r + l)
 
     def __lt__(self, other):
         return self.tagged_hash() < other.tagged_hash()
@@ -1217,61 +1382,49 @@ class Tapbranch():
     def __gt__(self, other):
         return self.tagged_hash() > other.tagged_hash()
 
+_MINISCRIPT_CORR_KEYS = frozenset(('z','o','n','d','u'))
+
 # Miniscript Node.
 class node_type:
+    __slots__ = ('script', 'nsat', 'sat_xy', 'sat_z', 'typ', 'corr', 'mal', 'children')
+
     def __init__(self, script=False, nsat=False, sat_xy=False, sat_z=False, typ=False, corr=False, mal=False, children=False, childnum=None):
-        self._script = script
-        self._nsat = nsat
-        self._sat_xy = sat_xy
-        self._sat_z= sat_z
-        self._typ = typ
-        self._corr = corr
-        self._mal = mal
+        # Node properties are computed by the factory from the (already
+        # constructed) children, and stored as plain values.
+        self.script = script
+        self.nsat = nsat
+        self.sat_xy = sat_xy
+        self.sat_z= sat_z
+        self.typ = typ
+        self.corr = corr
+        self.mal = mal
         self.children = children # [x,y,z]
 
         # Assert all corr/mal/child members are defined.
-        assert(all (key in corr(children).keys() for key in ('z','o','n','d','u')))
-        for _ , value in vars(self).items():
-            assert(value != None)
+        assert(corr.keys() >= _MINISCRIPT_CORR_KEYS)
+        assert(not any(value is None for value in (script, nsat, sat_xy, sat_z, typ, corr, mal, children)))
         # assert(len(children)==3) # This doesn't hold with threshold.
 
-    def __getattr__(self,name):
-        attr = getattr(self, '_'+name)
-        if attr != None:
-            # All lambda's must accept children argument.
-            return attr(self.children)
-        else:
-            return None
-
 # Factory class to generate miniscript nodes.
 class miniscript:
+    # Terminal tag -> function decoding the tag's string arguments.
+    _TERMINAL_ARGS = {
+        'pk': lambda exprs: [bytes.fromhex(exprs[0])],
+        'pk_h': lambda exprs: [bytes.fromhex(exprs[0])],
+        'older': lambda exprs: [int(exprs[0])],
+        'hash160': lambda exprs: [bytes.fromhex(exprs[0])],
+        'thresh_csa': lambda exprs: [int(exprs[0])] + [bytes.fromhex(key_string) for key_string in exprs[1:]],
+    }
+
     @staticmethod
     def decode(string):
         tag, exprs = miniscript._parse(string)
 
         # Return terminal expressions:
         # ['pk','pk_h','older','after','sha256','hash256','hash160','hash160','1','0']:
-        if tag in ['pk','pk_h', 'older', 'hash160', 'thresh_csa']:
-
-            if tag in ['pk', 'pk_h']:
-                key_b = bytes.fromhex(exprs[0])
-                return getattr(miniscript, tag)(key_b)
-
-            elif tag in ['older']:
-                n = int(exprs[0])
-                return getattr(miniscript, tag)(n)
-
-            elif tag in ['hash160']:
-                digest = bytes.fromhex(exprs[0])
-                return getattr(miniscript, tag)(digest)
-
-            elif tag in ['thresh_csa']:
-                k = int(exprs[0])
-                keys = []
-                for key_string in exprs[1:]:
-                    key_data = bytes.fromhex(key_string)
-                    keys.append(key_data)
-                return getattr(miniscript, tag)(k, *keys)
+        terminal_args = miniscript._TERMINAL_ARGS.get(tag)
+        if terminal_args is not None:
+            return getattr(miniscript, tag)(*terminal_args(exprs))
 
         child_nodes = []
         for expr in exprs:
@@ -1285,7 +1438,9 @@ class miniscript:
         depth = 0
         tag = ''
         exprs = []
-        for idx, ch in enumerate(string):
+        for m in _MINISCRIPT_DELIMITERS.finditer(string):
+            ch = m.group()
+            idx = m.start()
             if ch == ':' and depth == 0:
                 return string[:idx], [string[idx+1:]]
             if ch == '(':
@@ -1308,87 +1463,87 @@ class miniscript:
     @staticmethod
     def pk(key):
         assert(len(key) == 32)
-        script = lambda x: [key]
-        nsat = lambda x: [0]
-        sat_xy = lambda x: [('sig', key)]
-        sat_z = lambda x: [False]
-        typ = lambda x: 'K' # Only one possible.
-        corr = lambda x: {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
-        mal = lambda x: {'e': True,'f': False, 'm': True, 's': True}
+        script = [key]
+        nsat = [0]
+        sat_xy = [('sig', key)]
+        sat_z = [False]
+        typ = 'K' # Only one possible.
+        corr = {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
+        mal = {'e': True,'f': False, 'm': True, 's': True}
         children = [None, None, None] # Terminal.
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
     @staticmethod
     def older(n):
         assert(n >= 1 and n < 2**32)
-        script = lambda x: [CScriptNum(n), OP_CHECKSEQUENCEVERIFY]
-        nsat = lambda x: [False]
-        sat_xy = lambda x: []
-        sat_z = lambda x: [False]
-        typ = lambda x: 'B'
-        corr = lambda x: {'z': True,'o': False, 'n': False, 'd': False, 'u': False}
-        mal = lambda x: {'e': False,'f': True, 'm': True, 's': False}
+        script = [CScriptNum(n), OP_CHECKSEQUENCEVERIFY]
+        nsat = [False]
+        sat_xy = []
+        sat_z = [False]
+        typ = 'B'
+        corr = {'z': True,'o': False, 'n': False, 'd': False, 'u': False}
+        mal = {'e': False,'f': True, 'm': True, 's': False}
         children = [None, None, None] # Terminal.
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
     @staticmethod
     def hash160(data):
         assert(len(data) == 20)
-        script = lambda x: [OP_SIZE, CScriptNum(32), OP_EQUALVERIFY, OP_HASH160, data, OP_EQUAL]
-        nsat = lambda x: [b'\x00'*32] # Not non-malleably.
-        sat_xy = lambda x: [('preimage', data)]
-        sat_z = lambda x: [False]
-        typ = lambda x: 'B'
-        corr = lambda x: {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
-        mal = lambda x: {'e': False,'f': False, 'm': True, 's': False}
+        script = [OP_SIZE, CScriptNum(32), OP_EQUALVERIFY, OP_HASH160, data, OP_EQUAL]
+        nsat = [b'\x00'*32] # Not non-malleably.
+        sat_xy = [('preimage', data)]
+        sat_z = [False]
+        typ = 'B'
+        corr = {'z': False,'o': True, 'n': True, 'd': True, 'u': True}
+        mal = {'e': False,'f': False, 'm': True, 's': False}
         children = [None, None, None] # Terminal.
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
     @staticmethod
     def c(expr):
-        script = lambda x: x[0].script + [OP_CHECKSIG]
-        nsat = lambda x: x[0].nsat
-        sat_xy = lambda x: x[0].sat_xy
-        sat_z = lambda x: [False]
-        typ = lambda x: 'B' if x[0].typ == 'K' else False
-        corr = lambda x: {'z': False,'o': x[0].corr['o'], 'n': x[0].corr['n'], 'd': x[0].corr['d'], 'u': True}
-        mal = lambda x: {'f': False, 'e': x[0].mal['e'], 'm': x[0].mal['m'], 's': x[0].mal['s']}
+        script = expr.script + [OP_CHECKSIG]
+        nsat = expr.nsat
+        sat_xy = expr.sat_xy
+        sat_z = [False]
+        typ = 'B' if expr.typ == 'K' else False
+        corr = {'z': False,'o': expr.corr['o'], 'n': expr.corr['n'], 'd': expr.corr['d'], 'u': True}
+        mal = {'f': False, 'e': expr.mal['e'], 'm': expr.mal['m'], 's': expr.mal['s']}
         children = [expr, None, None]
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
     @staticmethod
     def v(expr):
-        script = lambda x: x[0].script + [OP_VERIFY]
-        nsat = lambda x: [False]
-        sat_xy = lambda x: x[0].sat_xy
-        sat_z = lambda x: [False]
-        typ = lambda x: 'V' if x[0].typ == 'B' else False
-        corr = lambda x: {'z': x[0].corr['z'],'o': x[0].corr['o'], 'n': x[0].corr['n'], 'd': False, 'u': False}
-        mal = lambda x: {'f': True, 'e': False, 'm': x[0].mal['m'], 's': x[0].mal['s']}
+        script = expr.script + [OP_VERIFY]
+        nsat = [False]
+        sat_xy = expr.sat_xy
+        sat_z = [False]
+        typ = 'V' if expr.typ == 'B' else False
+        corr = {'z': expr.corr['z'],'o': expr.corr['o'], 'n': expr.corr['n'], 'd': False, 'u': False}
+        mal = {'f': True, 'e': False, 'm': expr.mal['m'], 's': expr.mal['s']}
         children = [expr, None, None]
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
     @staticmethod
     def and_v(expr_l, expr_r):
-        script = lambda x: x[0].script + x[1].script
-        nsat = lambda x: [False]
-        sat_xy = lambda x: x[1].sat_xy + x[0].sat_xy
-        sat_z = lambda x: [False]
-        typ = lambda x:\
-            'B' if (x[0].typ == 'V' and x[1].typ == 'B') else\
-            'K' if (x[0].typ == 'V' and x[1].typ == 'K') else\
-            'V' if (x[0].typ == 'V' and x[1].typ == 'V') else False
-        corr = lambda x: {\
-            'z': bool(x[0].corr['z']*x[1].corr['z']),\
-            'o': bool(x[0].corr['z']*x[1].corr['o']+x[0].corr['o']*x[1].corr['z']),\
-            'n': bool(x[0].corr['n']+x[0].corr['z']*x[1].corr['n']),\
+        script = expr_l.script + expr_r.script
+        nsat = [False]
+        sat_xy = expr_r.sat_xy + expr_l.sat_xy
+        sat_z = [False]
+        typ = \
+            'B' if (expr_l.typ == 'V' and expr_r.typ == 'B') else\
+            'K' if (expr_l.typ == 'V' and expr_r.typ == 'K') else\
+            'V' if (expr_l.typ == 'V' and expr_r.typ == 'V') else False
+        corr = {\
+            'z': bool(expr_l.corr['z']*expr_r.corr['z']),\
+            'o': bool(expr_l.corr['z']*expr_r.corr['o']+expr_l.corr['o']*expr_r.corr['z']),\
+            'n': bool(expr_l.corr['n']+expr_l.corr['z']*expr_r.corr['n']),\
             'd': False,\
             'u': False}
-        mal = lambda x: {\
-            'f': bool(x[0].mal['f']*x[1].mal['f']),\
+        mal = {\
+            'f': bool(expr_l.mal['f']*expr_r.mal['f']),\
             'e': False,\
-            'm':bool(x[0].mal['m']*x[1].mal['m']),\
-            's': bool(x[0].mal['s']+x[1].mal['s'])}
+            'm':bool(expr_l.mal['m']*expr_r.mal['m']),\
+            's': bool(expr_l.mal['s']+expr_r.mal['s'])}
         children = [expr_l, expr_r, None]
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
 
@@ -1397,12 +1552,15 @@ class miniscript:
         assert(k > 0 and k <= len(args) and len(args) > 1) # Requires more than 1 pk.
         for key in args:
             assert(len(key) == 32)
-        script = lambda x: [args[0], OP_CHECKSIG] + list(itertools.chain.from_iterable([[args[i], OP_CHECKSIGADD] for i in range(1,len(args))])) + [k, OP_NUMEQUAL]
-        nsat = lambda x: [0x00]*len(args)
-        sat_xy = lambda x: [('sig', args[i]) for i in range(0,len(args))][::-1] # TODO: ('thresh(n)', [('sig', (0x02../0x00)), ('sig', (0x02../0x00))])
-        sat_z = lambda x: [False]
-        typ = lambda x: 'B'
-        corr = lambda x: {'z': False,'o': False, 'n': False, 'd': True, 'u': True}
-        mal = lambda x: {'f': False, 'e': True, 'm': True, 's': True}
+        script = [args[0], OP_CHECKSIG]
+        for key in args[1:]:
+            script.extend((key, OP_CHECKSIGADD))
+        script.extend((k, OP_NUMEQUAL))
+        nsat = [0x00]*len(args)
+        sat_xy = [('sig', args[i]) for i in range(0,len(args))][::-1] # TODO: ('thresh(n)', [('sig', (0x02../0x00)), ('sig', (0x02../0x00))])
+        sat_z = [False]
+        typ = 'B'
+        corr = {'z': False,'o': False, 'n': False, 'd': True, 'u': True}
+        mal = {'f': False, 'e': True, 'm': True, 's': True}
         children = [None, None, None] # Terminal expression.
         return node_type(script=script, nsat=nsat, sat_xy=sat_xy, sat_z=sat_z,  typ=typ, corr=corr, mal=mal,children=children)
@@ -1,35 +1,51 @@
-import argparse
-import configparser
 from io import BytesIO
+import functools
 import os
 import psutil
+import re
+from types import SimpleNamespace
 
+from test_framework.authproxy import JSONRPCException
 from test_framework.messages import (
     COutPoint,
     CTransaction,
     CTxIn,
     CTxOut,
 )
-from test_framework.test_framework import BitcoinTestFramework
 
-# Read configuration from config.ini
-config = configparser.ConfigParser()
+# Read configuration from config.ini. SOURCE_DIRECTORY is the only setting,
+# so pick it out directly rather than building a full ConfigParser.
 configfile = os.path.abspath(os.path.dirname(__file__)) + "/config.ini"
-config.read_file(open(configfile, encoding="utf8"))
+with open(configfile, "rb") as f:
+    config_text = f.read().decode("utf8")
+# Like ConfigParser, accept either '=' or ':' as the delimiter and any case for the key.
+source_directory_match = re.search(r'^\s*SOURCE_DIRECTORY\s*[=:](.*)$', config_text, re.M | re.I)
 
-SOURCE_DIRECTORY = config["path"]["SOURCE_DIRECTORY"]
+SOURCE_DIRECTORY = source_directory_match.group(1).strip() if source_directory_match else ''
 
-assert not SOURCE_DIRECTORY == '', 'SOURCE_DIRECTORY not configured! Edit config.ini to configure SOURCE_DIRECTORY.'
+# Not an assert, so that the check also happens under python -O.
+if not SOURCE_DIRECTORY:
+    raise RuntimeError('SOURCE_DIRECTORY not configured! Edit config.ini to configure SOURCE_DIRECTORY.')
 
-print("Source directory configured as {}".format(SOURCE_DIRECTORY))
+# Set TAPROOT_QUIET to 1, true or yes (case-insensitive) in the environment to
+# skip the banner. Any other value, such as 0 or false, keeps it.
+if os.environ.get("TAPROOT_QUIET", "").lower() not in ("1", "true", "yes"):
+    print(f"Source directory configured as {SOURCE_DIRECTORY}")
 
-class TestWrapper:
-    """Singleton TestWrapper class.
+# Default paths into the Bitcoin Core source directory
+_SRC = os.path.abspath(SOURCE_DIRECTORY)
+BITCOIND_PATH = os.path.join(_SRC, "src", "bitcoind")
+CACHE_DIR = os.path.join(_SRC, "test", "cache")
+TEST_CONFIGFILE = os.path.join(_SRC, "test", "config.ini")
 
-    This wraps the actual TestWrapper class to ensure that users only ever
-    instantiate a single TestWrapper."""
+def _test_wrapper_class():
+    """Return the class implementing TestWrapper.
+
+    BitcoinTestFramework pulls in most of the test framework, so only import
+    it once a TestWrapper is actually created."""
+    from test_framework.test_framework import BitcoinTestFramework
 
-    class __TestWrapper(BitcoinTestFramework):
+    class _TestWrapperImpl(BitcoinTestFramework):
         """Wrapper Class for BitcoinTestFramework.
 
         Provides the BitcoinTestFramework rpc & daemon process management
@@ -43,7 +59,7 @@ class TestWrapper:
             pass
 
         def setup(self,
-                  bitcoind=os.path.abspath(SOURCE_DIRECTORY + "/src/bitcoind"),
+                  bitcoind=BITCOIND_PATH,
                   bitcoincli=None,
                   setup_clean_chain=True,
                   num_nodes=1,
@@ -53,13 +69,13 @@ class TestWrapper:
                   bind_to_localhost_only=True,
                   nocleanup=False,
                   noshutdown=False,
-                  cachedir=os.path.abspath(SOURCE_DIRECTORY + "/test/cache"),
+                  cachedir=CACHE_DIR,
                   tmpdir=None,
                   loglevel='INFO',
                   trace_rpc=False,
-                  port_seed=os.getpid(),
+                  port_seed=None,
                   coveragedir=None,
-                  configfile=os.path.abspath(SOURCE_DIRECTORY + "/test/config.ini"),
+                  configfile=TEST_CONFIGFILE,
                   pdbonfailure=False,
                   usecli=False,
                   perf=False,
@@ -69,11 +85,15 @@ class TestWrapper:
                 print("TestWrapper is already running!")
                 return
 
-            # Check whether there are any bitcoind processes running on the system
-            for p in [proc for proc in psutil.process_iter() if 'bitcoin' in proc.name()]:
-                if p.exe().split('/')[-1] == 'bitcoind':
-                    print("bitcoind processes are already running on this system. Please shutdown all bitcoind processes!")
-                    return
+            # Check whether there are any bitcoind processes running on the system.
+            # Only fetch process names, rather than querying each process separately.
+            if any(proc.info['name'] == 'bitcoind' for proc in psutil.process_iter(['name'])):
+                print("bitcoind processes are already running on this system. Please shutdown all bitcoind processes!")
+                return
+
+            # Default to the pid of the current process, not the one that imported util.
+            if port_seed is None:
+                port_seed = os.getpid()
 
             self.setup_clean_chain = setup_clean_chain
             self.num_nodes = num_nodes
@@ -82,23 +102,24 @@ class TestWrapper:
             self.supports_cli = supports_cli
             self.bind_to_localhost_only = bind_to_localhost_only
 
-            self.options = argparse.Namespace
-            self.options.nocleanup = nocleanup
-            self.options.noshutdown = noshutdown
-            self.options.cachedir = cachedir
-            self.options.tmpdir = tmpdir
-            self.options.loglevel = loglevel
-            self.options.trace_rpc = trace_rpc
-            self.options.port_seed = port_seed
-            self.options.coveragedir = coveragedir
-            self.options.configfile = configfile
-            self.options.pdbonfailure = pdbonfailure
-            self.options.usecli = usecli
-            self.options.perf = perf
-            self.options.randomseed = randomseed
-
-            self.options.bitcoind = bitcoind
-            self.options.bitcoincli = bitcoincli
+            # A fresh namespace per setup, so that options don't leak between runs.
+            self.options = SimpleNamespace(
+                nocleanup=nocleanup,
+                noshutdown=noshutdown,
+                cachedir=cachedir,
+                tmpdir=tmpdir,
+                loglevel=loglevel,
+                trace_rpc=trace_rpc,
+                port_seed=port_seed,
+                coveragedir=coveragedir,
+                configfile=configfile,
+                pdbonfailure=pdbonfailure,
+                usecli=usecli,
+                perf=perf,
+                randomseed=randomseed,
+                bitcoind=bitcoind,
+                bitcoincli=bitcoincli,
+            )
 
             super().setup()
 
@@ -106,6 +127,7 @@ class TestWrapper:
             for node in self.nodes:
                 node.generate_and_send_coins = generate_and_send_coins.__get__(node)
                 node.test_transaction = test_transaction.__get__(node)
+                node.test_transactions = test_transactions.__get__(node)
             self.running = True
 
         def create_spending_transaction(self, txid, version=1, nSequence=0):
@@ -142,19 +164,24 @@ class TestWrapper:
                 super().shutdown()
                 self.running = False
 
-    instance = None
+    return _TestWrapperImpl
 
-    def __new__(cls):
-        if not TestWrapper.instance:
-            TestWrapper.instance = TestWrapper.__TestWrapper()
-            TestWrapper.instance.running = False
-        return TestWrapper.instance
+@functools.lru_cache(maxsize=None)
+def _test_wrapper_instance():
+    """Return the single TestWrapper instance, creating it on first use."""
+    instance = _test_wrapper_class()()
+    instance.running = False
+    return instance
 
-    def __getattr__(self, name):
-        return getattr(self.instance, name)
+class TestWrapper:
+    """Singleton TestWrapper class.
 
-    def __setattr__(self, name):
-        return setattr(self.instance, name)
+    This wraps the actual TestWrapper class to ensure that users only ever
+    instantiate a single TestWrapper. TestWrapper() returns that instance
+    itself, so attribute access doesn't go through a proxy."""
+
+    def __new__(cls):
+        return _test_wrapper_instance()
 
 def generate_and_send_coins(node, address):
     """Generate blocks on node and then send 1 BTC to address.
@@ -188,12 +215,12 @@ def generate_and_send_coins(node, address):
 
     txid = node.sendrawtransaction(hexstring=tx_hex, maxfeerate=0)
 
-    tx_hex = node.getrawtransaction(txid)
-
-    # Reconstruct wallet transaction locally
+    # Reconstruct wallet transaction locally from the signed transaction we
+    # just sent. The node has already computed its txid.
     tx = CTransaction()
     tx.deserialize(BytesIO(bytes.fromhex(tx_hex)))
-    tx.rehash()
+    tx.sha256 = int(txid, 16)
+    tx.hash = txid
 
     return tx
 
@@ -202,3 +229,19 @@ def test_transaction(node, tx):
     ret = node.testmempoolaccept(rawtxs=[tx_str], maxfeerate=0)[0]
     print(ret)
     return ret['allowed']
+
+def test_transactions(node, txs):
+    """Test mempool acceptance of several transactions with a single batched RPC.
+
+    Each transaction is tested on its own, so they may spend the same outputs.
+    Return a list with whether each transaction was accepted."""
+    requests = [node.testmempoolaccept.get_request(rawtxs=[tx.serialize().hex()], maxfeerate=0) for tx in txs]
+    allowed = []
+    for response in node.batch(requests):
+        error = response.get('error')
+        if error is not None:
+            raise error if isinstance(error, JSONRPCException) else JSONRPCException(error)
+        ret = response['result'][0]
+        print(ret)
+        allowed.append(ret['allowed'])
+    return allowed